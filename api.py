@@ -1,35 +1,108 @@
-from flask import Flask, request
-from flask_restx import Resource, Api, fields, reqparse, abort, marshal, marshal_with
-from configparser import ConfigParser
+from flask import Flask, Response, request, stream_with_context
+from flask import g as flask_g
+from werkzeug.middleware.proxy_fix import ProxyFix
+from flask_restx import Resource, Api, fields, inputs, reqparse, abort, marshal, marshal_with
 import psycopg2 as pg
-from psycopg2 import extensions
+from psycopg2 import extensions, pool as pg_pool
 from healthcheck import HealthCheck, EnvironmentDump
 #from prometheus_flask_exporter import PrometheusMetrics, RESTfulPrometheusMetrics
-from prometheus_client import Gauge, generate_latest
+from prometheus_client import Counter, Gauge, Histogram, generate_latest
 from fluent import sender, handler
 import logging
-from time import time
+from time import time, monotonic, perf_counter, sleep, thread_time
 import json
+import atexit
+import dataclasses
 import os
-import subprocess
 import socket
 import random
+import re
+import sys
+import signal
+import hmac
+import queue
+import threading
+import zlib
+import hashlib
+import math
+from array import array
+from collections import OrderedDict
+
+try:
+    from time import clock_gettime, pthread_getcpuclockid
+except ImportError:
+    pass
 
 app = Flask(__name__)
 
-# Load configurations from the config file
-def load_configurations():
-    app.config.from_file("config.json", load=json.load)
 
-    with open("config.json") as json_file:
-        data = json.load(json_file)
-        # Override variables defined in the config file with the ones defined in the environment(if set)
-        for item in data:
-            if os.environ.get(item):
-                app.config[item] = os.environ.get(item)
-
-
-load_configurations()
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    """
+    Nastavitve aplikacije iz datoteke config.json. Spremenljivke okolja z enakim imenom
+    (npr. DATABASE_IP) povozijo vrednosti iz datoteke in se pretvorijo v tip polja.
+    """
+
+    database_ip: str
+    database_port: int
+    pgdatabase: str
+    pguser: str
+    pgpassword: str
+    fluent_ip: str
+    fluent_port: int
+    export_chunk_size: int
+    export_queue_size: int
+    max_inflight_tocka: int
+    max_inflight_pregled: int
+    max_inflight_izvoz: int
+    admission_queue_size: int
+    admission_queue_timeout: float
+    retry_after: float
+    rate_limit_rate: float
+    rate_limit_burst: float
+    rate_limit_max_clients: int
+    trusted_proxy_hops: int
+    idempotency_ttl: float
+    idempotency_max_keys: int
+    db_pool_min: int
+    db_pool_max: int
+    statement_timeout_tocka: int
+    statement_timeout_pregled: int
+    statement_timeout_izvoz: int
+    slow_query_ms: float
+    explain_slow_queries: bool
+    admin_token: str
+    profiler_interval_ms: float
+    rating_durability: str
+    rating_flush_interval_ms: float
+    rating_batch_size: int
+    snapshot_enabled: bool
+    snapshot_max_age: float
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as json_file:
+            data = json.load(json_file)
+        values = {}
+        for field in dataclasses.fields(cls):
+            key = field.name.upper()
+            value = os.environ.get(key) or data[key]
+            if field.type is bool and isinstance(value, str):
+                value = value.lower() in ("1", "true", "yes")
+            values[field.name] = field.type(value)
+        return cls(**values)
+
+
+settings = None
+started = False
+startLock = threading.Lock()
+
+
+# Pri zagonu z app.run se init_app poklice pred prvo zahtevo, sicer ob prvi zahtevi
+@app.before_request
+def start_app():
+    if not started:
+        init_app()
 
 
 @app.route("/")
@@ -50,26 +123,8 @@ custom_format = {
     "status": "%(status)s",
     "code": "%(http_code)s",
 }
-logging.basicConfig(level=logging.INFO)
 l = logging.getLogger("Uporabniki")
-h = handler.FluentHandler(
-    "Uporabniki", host=app.config["FLUENT_IP"], port=int(app.config["FLUENT_PORT"])
-)
-formatter = handler.FluentRecordFormatter(custom_format)
-h.setFormatter(formatter)
-l.addHandler(h)
-
-l.info(
-    "Setting up Uporabniki App",
-    extra={
-        "name_of_service": "Uporabniki",
-        "crud_method": None,
-        "directions": None,
-        "ip_node": None,
-        "status": None,
-        "http_code": None,
-    },
-)
+fluentHandler = None
 
 api = Api(
     app,
@@ -127,30 +182,388 @@ ns = api.namespace(
 posodobiModel = api.model(
     "PosodobiNarocnika", {"atribut": fields.String, "vrednost": fields.String}
 )
+posodobiOcenoModel = api.model("PosodobiOceno", {"vrednost": fields.Integer})
 
 #metrics = RESTfulPrometheusMetrics(app, api)
 
 
-def connect_to_database():
-    return pg.connect(
-        database=app.config["PGDATABASE"],
-        user=app.config["PGUSER"],
-        password=app.config["PGPASSWORD"],
-        port=app.config["DATABASE_PORT"],
-        host=app.config["DATABASE_IP"],
-        connect_timeout=3,
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class AdmissionControl:
+    """
+    Nadzor sprejema zahtev: omejeno stevilo hkratnih zahtev na razred koncnih tock
+    z omejeno cakalno vrsto in token bucket omejitev hitrosti na odjemalca.
+    """
+
+    def __init__(self, limits, queue_size, queue_timeout, rate, burst, max_clients):
+        self.slots = {k: threading.BoundedSemaphore(v) for k, v in limits.items()}
+        self.waiting = {k: 0 for k in limits}
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def check_client(self, key):
+        """
+        Vrne None, ce ima odjemalec na voljo zeton, sicer stevilo sekund do naslednjega.
+        Zetona ne porabi, to stori sele consume po sprejemu zahteve.
+        """
+        if self.rate <= 0:
+            return None
+        now = monotonic()
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.burst, now)
+            else:
+                bucket.tokens = min(
+                    self.burst, bucket.tokens + (now - bucket.updated) * self.rate
+                )
+                bucket.updated = now
+            # Najdlje neaktivni odjemalci so na zacetku, zato je slovar omejen
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+            if bucket.tokens >= 1:
+                return None
+            return (1 - bucket.tokens) / self.rate
+
+    def consume(self, key):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.tokens -= 1
+
+    def acquire(self, razred):
+        slots = self.slots[razred]
+        if slots.acquire(blocking=False):
+            return True
+        with self.lock:
+            if self.waiting[razred] >= self.queue_size:
+                return False
+            self.waiting[razred] += 1
+        try:
+            return slots.acquire(timeout=self.queue_timeout)
+        finally:
+            with self.lock:
+                self.waiting[razred] -= 1
+
+    def release(self, razred):
+        self.slots[razred].release()
+
+
+admission = None
+zavrnjene = Counter(
+    "Zavrnjene_zahteve", "Število zavrnjenih zahtev", ["razred", "razlog"]
+)
+vObdelavi = Gauge("Zahteve_v_obdelavi", "Število zahtev v obdelavi", ["razred"])
+
+
+def request_class():
+    view = app.view_functions.get(request.endpoint)
+    razred = getattr(getattr(view, "view_class", None), "razred_obremenitve", None)
+    if isinstance(razred, dict):
+        method = request.method.lower()
+        # Werkzeug vsakemu GET pravilu doda HEAD, ki ga flask-restx obdela z get
+        if method == "head":
+            method = "get"
+        razred = razred.get(method)
+    return razred
+
+
+untrustedForwardWarned = False
+
+
+def client_key():
+    # Glave, ki jih nastavi odjemalec, bi lahko spreminjal ob vsaki zahtevi in tako dobil
+    # nov zeton; za zaupanja vrednimi posredniki remote_addr popravi ProxyFix
+    global untrustedForwardWarned
+    if (
+        not untrustedForwardWarned
+        and settings.trusted_proxy_hops == 0
+        and admission.rate > 0
+        and "X-Forwarded-For" in request.headers
+    ):
+        untrustedForwardWarned = True
+        l.warning(
+            "Zahteva ima X-Forwarded-For, TRUSTED_PROXY_HOPS pa je 0: vsi odjemalci za "
+            "posrednikom si delijo omejitev hitrosti",
+            extra={
+                "name_of_service": "Uporabniki",
+                "crud_method": None,
+                "directions": "in",
+                "ip_node": None,
+                "status": "fail",
+                "http_code": None,
+            },
+        )
+    return request.remote_addr or ""
+
+
+def shed(razred, razlog, http_code, retry_after, message):
+    zavrnjene.labels(razred, razlog).inc()
+    l.warning(
+        "Zahteva zavrnjena (%s, %s)" % (razred, razlog),
+        extra={
+            "name_of_service": "Uporabniki",
+            "crud_method": request.method.lower(),
+            "directions": "out",
+            "ip_node": socket.gethostbyname(socket.gethostname()),
+            "status": "fail",
+            "http_code": http_code,
+        },
+    )
+    return (
+        {"message": message},
+        http_code,
+        {"Retry-After": str(max(1, int(math.ceil(retry_after))))},
     )
 
 
+# Zavrnitev se zgodi pred ustvarjanjem Resource objekta in s tem pred povezavo z bazo
+@app.before_request
+def admit_request():
+    razred = request_class()
+    if razred is None:
+        return None
+    key = client_key()
+    retry_after = admission.check_client(key)
+    if retry_after is not None:
+        return shed(razred, "omejitev_hitrosti", 429, retry_after, "Preveč zahtev")
+    if not admission.acquire(razred):
+        return shed(
+            razred,
+            "preobremenitev",
+            503,
+            settings.retry_after,
+            "Storitev je preobremenjena",
+        )
+    # Zeton se porabi le za sprejete zahteve, zavrnitev 503 ga ne stane
+    admission.consume(key)
+    flask_g.razred_obremenitve = razred
+    vObdelavi.labels(razred).inc()
+    return None
+
+
+@app.teardown_request
+def release_request(exc):
+    razred = flask_g.pop("razred_obremenitve", None)
+    if razred is not None:
+        vObdelavi.labels(razred).dec()
+        admission.release(razred)
+
+
+class SamplingProfiler:
+    """
+    Vzorcevalni profiler: vzorcevalna nit v rednih intervalih prebere sklade niti, ki
+    obdelujejo izbrane zahteve, in steje vzorce po skladih. Pretecen cas in cas CPU niti
+    med dvema vzorcema se pripiseta trenutnemu skladu. Ko je izklopljen, zahteve
+    preverijo le active.
+    """
+
+    def __init__(self, interval, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.active = False
+        self.fraction = 1.0
+        self.until = None
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # ident niti -> [koncna tocka, cas CPU ob zadnjem vzorcu, cas zadnjega vzorca]
+            self.threads = {}
+            # strnjen sklad -> [stevilo vzorcev, cas, cas CPU]
+            self.stacks = {}
+            # koncna tocka -> [zahteve, cas, cas CPU]
+            self.endpoints = {}
+
+    def start(self, fraction, duration):
+        self.stop()
+        self.reset()
+        self.fraction = fraction
+        self.until = monotonic() + duration if duration > 0 else None
+        self.active = True
+        self.sampler = threading.Thread(target=self.run, daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        self.active = False
+        sampler, self.sampler = self.sampler, None
+        if sampler is not None and sampler is not threading.current_thread():
+            sampler.join()
+
+    def begin_request(self, endpoint):
+        if random.random() >= self.fraction:
+            return False
+        ident = threading.get_ident()
+        with self.lock:
+            self.threads[ident] = [endpoint, thread_cpu_time(ident), perf_counter()]
+        return True
+
+    def end_request(self, endpoint, wall, cpu):
+        with self.lock:
+            self.threads.pop(threading.get_ident(), None)
+            stats = self.endpoints.setdefault(endpoint, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += wall
+            stats[2] += cpu
+
+    def frame_names(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(
+                "%s (%s:%d)"
+                % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+            )
+            frame = frame.f_back
+        names.reverse()
+        return names
+
+    def run(self):
+        while self.active:
+            sleep(self.interval)
+            if self.until is not None and monotonic() >= self.until:
+                self.active = False
+                break
+            frames = sys._current_frames()
+            now = perf_counter()
+            with self.lock:
+                for ident, state in self.threads.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    cpu = thread_cpu_time(ident)
+                    key = ";".join([state[0]] + self.frame_names(frame))
+                    sample = self.stacks.setdefault(key, [0, 0.0, 0.0])
+                    sample[0] += 1
+                    sample[1] += now - state[2]
+                    if cpu is not None and state[1] is not None:
+                        sample[2] += cpu - state[1]
+                    state[1] = cpu
+                    state[2] = now
+
+    def collapsed(self):
+        """
+        Strnjeni skladi v obliki, ki jo berejo flamegraph.pl, speedscope in inferno
+        """
+        with self.lock:
+            return "".join(
+                "%s %d\n" % (key, sample[0]) for key, sample in self.stacks.items()
+            )
+
+    def summary(self):
+        functions = {}
+        with self.lock:
+            for key, (samples, wall, cpu) in self.stacks.items():
+                names = key.split(";")[1:]
+                for i, name in enumerate(names):
+                    # Rekurzivna funkcija se v skupnem casu steje enkrat na vzorec
+                    if name in names[:i]:
+                        continue
+                    stats = functions.setdefault(name, [0, 0.0, 0.0, 0.0, 0.0])
+                    stats[0] += samples
+                    stats[1] += wall
+                    stats[3] += cpu
+                    if i == len(names) - 1:
+                        stats[2] += wall
+                        stats[4] += cpu
+            endpoints = {
+                endpoint: {"zahteve": n, "cas": wall, "cas_cpu": cpu}
+                for endpoint, (n, wall, cpu) in self.endpoints.items()
+            }
+        return {
+            "aktiven": self.active,
+            "delez": self.fraction,
+            "interval": self.interval,
+            "koncne_tocke": endpoints,
+            "funkcije": {
+                name: {
+                    "vzorci": samples,
+                    "cas": total,
+                    "lastni_cas": own,
+                    "cas_cpu": total_cpu,
+                    "lastni_cas_cpu": own_cpu,
+                }
+                for name, (samples, total, own, total_cpu, own_cpu) in sorted(
+                    functions.items(), key=lambda item: item[1][0], reverse=True
+                )
+            },
+        }
+
+
+def thread_cpu_time(ident):
+    try:
+        return clock_gettime(pthread_getcpuclockid(ident))
+    except (NameError, OSError):
+        return None
+
+
+profiler = None
+
+
+@app.before_request
+def profile_request():
+    if not profiler.active:
+        return None
+    if request.endpoint == "profiler":
+        return None
+    if profiler.begin_request(request.endpoint or request.path):
+        flask_g.profil = (perf_counter(), thread_time())
+    return None
+
+
+@app.teardown_request
+def profile_request_end(exc):
+    start = flask_g.pop("profil", None)
+    if start is not None:
+        profiler.end_request(
+            request.endpoint or request.path,
+            perf_counter() - start[0],
+            thread_time() - start[1],
+        )
+
+
+def require_admin():
+    token = settings.admin_token
+    given = request.headers.get("X-Admin-Token", "")
+    if not token or not hmac.compare_digest(given.encode("utf-8"), token.encode("utf-8")):
+        l.warning(
+            "Zavrnjen dostop do administratorske koncne tocke",
+            extra={
+                "name_of_service": "Uporabniki",
+                "crud_method": request.method.lower(),
+                "directions": "out",
+                "ip_node": socket.gethostbyname(socket.gethostname()),
+                "status": "fail",
+                "http_code": 403,
+            },
+        )
+        abort(403, "Dostop zavrnjen")
+
+
 # Kubernetes Liveness Probe (200-399 healthy, 400-599 sick)
 def check_database_connection():
-    conn = connect_to_database()
-    if conn.poll() == extensions.POLL_OK:
-        print("POLL: POLL_OK")
-    if conn.poll() == extensions.POLL_READ:
-        print("POLL: POLL_READ")
-    if conn.poll() == extensions.POLL_WRITE:
-        print("POLL: POLL_WRITE")
+    # Povezava iz bazena, da sonda ne odpira nove povezave z bazo ob vsakem klicu
+    db = Database(get_connection_pool())
+    try:
+        db.fetchone("preveri_povezavo")
+    finally:
+        db.release()
     l.info(
         "Healtcheck povezave z bazo",
         extra={
@@ -183,6 +596,61 @@ def application_data():
     }
 
 
+class IdempotencyStore:
+    """
+    Hrani Idempotency-Key kljuce z omejenim casom veljavnosti. Namesto kljucev in
+    podatkov zahtev hrani le njihove 16-bajtne povzetke in ID ustvarjenega narocnika.
+    """
+
+    # None ne more biti ID narocnika, -1 pa je veljaven ID
+    IN_PROGRESS = None
+
+    def __init__(self, ttl, max_keys):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        # povzetek kljuca -> (cas poteka, povzetek podatkov, ID narocnika)
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(value):
+        return hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+
+    def _expire(self, now):
+        # Vsi kljuci imajo enak TTL, zato so najstarejsi vedno na zacetku
+        while self.keys:
+            key, entry = next(iter(self.keys.items()))
+            if entry[0] > now and len(self.keys) <= self.max_keys:
+                break
+            self.keys.popitem(last=False)
+
+    def begin(self, key, payload):
+        """
+        Vrne None, ce je kljuc nov, sicer par (enaki podatki, ID narocnika)
+        """
+        now = monotonic()
+        key, payload = self.digest(key), self.digest(payload)
+        with self.lock:
+            self._expire(now)
+            entry = self.keys.get(key)
+            if entry is not None:
+                return entry[1] == payload, entry[2]
+            self.keys[key] = (now + self.ttl, payload, self.IN_PROGRESS)
+            return None
+
+    def finish(self, key, payload, id):
+        key, payload = self.digest(key), self.digest(payload)
+        with self.lock:
+            entry = self.keys.get(key)
+            if entry is not None:
+                self.keys[key] = (entry[0], payload, id)
+
+    def cancel(self, key):
+        with self.lock:
+            self.keys.pop(self.digest(key), None)
+
+
+idempotency = None
 class NarocnikModel:
     def __init__(self, id, ime, priimek, ocena, uporabnisko_ime, telefonska_stevilka):
         self.id = id
@@ -220,19 +688,284 @@ narocnikiPolja = {
 }
 
 
-class Narocnik(Resource):
+class PreparedConnection(extensions.connection):
+    """
+    Povezava, ki si zapomni stavke, pripravljene na strezniku, in trenutni statement_timeout
+    """
+
     def __init__(self, *args, **kwargs):
-        self.table_name = "narocniki"
-        self.conn = connect_to_database()
+        super(PreparedConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+        self.statement_timeout = None
+
+
+class Statement:
+    __slots__ = ("name", "sql", "razred", "nparams")
+
+    def __init__(self, name, sql, razred):
+        self.name = name
+        self.sql = sql
+        self.razred = razred
+        self.nparams = len(set(re.findall(r"\$(\d+)", sql)))
+
+
+stavki = {}
+
+
+def statement(name, sql, razred):
+    stavki[name] = Statement(name, sql, razred)
+
+
+statement("narocnik_po_id", "SELECT * FROM narocniki WHERE id = $1", "tocka")
+statement("vsi_narocniki", "SELECT * FROM narocniki", "pregled")
+statement("preveri_povezavo", "SELECT 1", "tocka")
+statement(
+    "izbrisi_narocnika", "DELETE FROM narocniki WHERE id = $1 RETURNING id", "tocka"
+)
+for polje in narocnikiPolja:
+    if polje != "id":
+        statement(
+            "posodobi_%s" % polje,
+            "UPDATE narocniki SET %s = $1 WHERE id = $2" % polje,
+            "tocka",
+        )
+statement(
+    "dodaj_narocnika",
+    """INSERT INTO narocniki (id, ime, priimek, ocena, uporabnisko_ime, telefonska_stevilka)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (id) DO NOTHING
+        RETURNING id""",
+    "tocka",
+)
+statement("zakleni_id", "SELECT pg_advisory_xact_lock($1)", "tocka")
+statement(
+    "dodaj_narocnika_brez_indeksa",
+    """INSERT INTO narocniki (id, ime, priimek, ocena, uporabnisko_ime, telefonska_stevilka)
+        SELECT $1, $2, $3, $4, $5, $6
+        WHERE NOT EXISTS (SELECT 1 FROM narocniki WHERE id = $1)
+        RETURNING id""",
+    "tocka",
+)
+statement(
+    "primerjaj_narocnika",
+    """SELECT id, rtrim(ime), rtrim(priimek), rtrim(ocena),
+              rtrim(uporabnisko_ime), coalesce(rtrim(telefonska_stevilka), '')
+       FROM narocniki WHERE id = $1""",
+    "tocka",
+)
+# Najvecja ocena po absolutni vrednosti: 18 stevk se vedno sesteje v bigint brez
+# prekoracitve, rezultat pa se omeji nanjo, da ostane veljavna ocena za naslednje povecanje
+MAX_OCENA = 10 ** 18 - 1
+
+# Vec posodobitev ocen v enem stavku: tabele se razpakirajo v vrstice (id, nastavi, vrednost).
+# Ocena je prosto besedilo, zato se povecanje ocene, ki ni celo stevilo, steje od 0.
+statement(
+    "posodobi_ocene",
+    """UPDATE narocniki AS n
+       SET ocena = greatest(least(CASE WHEN v.nastavi THEN v.vrednost
+                                       WHEN trim(n.ocena) ~ '^-?[0-9]{1,18}$'
+                                       THEN trim(n.ocena)::bigint + v.vrednost
+                                       ELSE v.vrednost
+                                  END, %(max)d), -%(max)d)::text
+       FROM unnest($1::int[], $2::bool[], $3::bigint[]) AS v(id, nastavi, vrednost)
+       WHERE n.id = v.id
+       RETURNING n.id, rtrim(n.ocena)"""
+    % {"max": MAX_OCENA},
+    "tocka",
+)
+statement(
+    "izvoz_csv",
+    """COPY (
+            SELECT id, rtrim(ime) AS ime, rtrim(priimek) AS priimek,
+                   rtrim(ocena) AS ocena, rtrim(uporabnisko_ime) AS uporabnisko_ime,
+                   rtrim(telefonska_stevilka) AS telefonska_stevilka
+            FROM narocniki
+         ) TO STDOUT WITH (FORMAT csv, HEADER true)""",
+    "izvoz",
+)
+# JSON vrstice ne vsebujejo kontrolnih znakov \x01 in \x02, zato jih CSV
+# nacin izpise dobesedno (brez podvajanja poševnic kot v tekstovnem nacinu)
+statement(
+    "izvoz_ndjson",
+    """COPY (
+            SELECT json_build_object(
+                'id', id, 'ime', rtrim(ime), 'priimek', rtrim(priimek),
+                'ocena', rtrim(ocena), 'uporabnisko_ime', rtrim(uporabnisko_ime),
+                'telefonska_stevilka', rtrim(telefonska_stevilka)
+            )
+            FROM narocniki
+         ) TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')""",
+    "izvoz",
+)
+
+statementTimeouts = None
+trajanjePoizvedb = Histogram(
+    "Trajanje_poizvedb", "Trajanje poizvedb v sekundah", ["stavek"]
+)
+
+
+class Database:
+    """
+    Dostop do baze za eno zahtevo: poimenovani stavki se na strezniku pripravijo enkrat
+    na povezavo, vsak razred stavkov ima svoj statement_timeout, trajanje vsakega
+    stavka se zabelezi, pocasni stavki pa se izpisejo v dnevnik skupaj z nacrtom izvajanja.
+    """
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.conn = connections.getconn()
         self.cur = self.conn.cursor()
-        self.cur.execute(
+
+    def _set_timeout(self, razred):
+        timeout = statementTimeouts[razred]
+        if self.conn.statement_timeout != timeout:
+            self.cur.execute("SET statement_timeout = %s", (timeout,))
+            self.conn.statement_timeout = timeout
+
+    def execute(self, name, params=None):
+        stavek = stavki[name]
+        if stavek.nparams:
+            sql = "EXECUTE %s (%s)" % (name, ", ".join(["%s"] * stavek.nparams))
+        else:
+            sql = "EXECUTE %s" % name
+        try:
+            self._set_timeout(stavek.razred)
+            if name not in self.conn.prepared:
+                self.cur.execute("PREPARE %s AS %s" % (name, stavek.sql))
+                self.conn.prepared.add(name)
+            start = perf_counter()
+            self.cur.execute(sql, params)
+            duration = perf_counter() - start
+        except pg.Error:
+            self.rollback()
+            raise
+        trajanjePoizvedb.labels(name).observe(duration)
+        if duration * 1000 >= settings.slow_query_ms:
+            self.log_slow(name, duration, sql, params)
+        return self.cur
+
+    def fetchone(self, name, params=None):
+        return self.execute(name, params).fetchone()
+
+    def fetchall(self, name, params=None):
+        return self.execute(name, params).fetchall()
+
+    def copy(self, name, file):
+        # Trajanje COPY je omejeno s hitrostjo odjemalca, zato ga ne belezimo kot pocasnega
+        stavek = stavki[name]
+        try:
+            self._set_timeout(stavek.razred)
+            start = perf_counter()
+            self.cur.copy_expert(stavek.sql, file)
+            duration = perf_counter() - start
+        except pg.Error:
+            self.rollback()
+            raise
+        trajanjePoizvedb.labels(name).observe(duration)
+
+    def log_slow(self, name, duration, sql, params):
+        plan = None
+        if settings.explain_slow_queries:
+            cur = self.conn.cursor()
+            try:
+                cur.execute("SAVEPOINT razlozi")
+                cur.execute("EXPLAIN " + sql, params)
+                plan = "\n".join(row[0] for row in cur.fetchall())
+                cur.execute("RELEASE SAVEPOINT razlozi")
+            except pg.Error:
+                cur.execute("ROLLBACK TO SAVEPOINT razlozi")
+        l.warning(
+            "Pocasen stavek %s (%.1f ms)%s"
+            % (name, duration * 1000, "\n" + plan if plan else ""),
+            extra={
+                "name_of_service": "Uporabniki",
+                "crud_method": "sql",
+                "directions": "out",
+                "ip_node": socket.gethostbyname(socket.gethostname()),
+                "status": "slow",
+                "http_code": None,
+            },
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        # Razveljavljena transakcija razveljavi tudi SET statement_timeout
+        self.conn.rollback()
+        self.conn.statement_timeout = None
+
+    def release(self):
+        if self.conn.closed:
+            self.connections.putconn(self.conn, close=True)
+            return
+        if self.conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            self.rollback()
+        self.connections.putconn(self.conn)
+
+
+connectionPool = None
+connectionPoolLock = threading.Lock()
+
+
+def get_connection_pool():
+    global connectionPool
+    with connectionPoolLock:
+        if connectionPool is None:
+            connectionPool = pg_pool.ThreadedConnectionPool(
+                settings.db_pool_min,
+                settings.db_pool_max,
+                database=settings.pgdatabase,
+                user=settings.pguser,
+                password=settings.pgpassword,
+                port=settings.database_port,
+                host=settings.database_ip,
+                connect_timeout=3,
+                connection_factory=PreparedConnection,
+            )
+    return connectionPool
+
+
+schemaReady = False
+schemaLock = threading.Lock()
+unique_id_index = None
+
+
+def has_unique_id_index(db):
+    # Tabele, ustvarjene s PRIMARY KEY ali UNIQUE (id), ze imajo ustrezen indeks
+    db.cur.execute(
+        """SELECT exists(
+               SELECT 1 FROM pg_index i
+               JOIN pg_attribute a
+                 ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+               WHERE i.indrelid = 'narocniki'::regclass
+                 AND i.indisunique AND i.indisvalid AND i.indpred IS NULL
+                 AND i.indnkeyatts = 1 AND a.attname = 'id'
+           )"""
+    )
+    exists = db.cur.fetchone()[0]
+    db.commit()
+    return exists
+
+
+def ensure_schema(db):
+    """
+    Enkrat na proces ustvari tabelo narocniki in unikatni indeks nad stolpcem id,
+    ki ga potrebuje INSERT ... ON CONFLICT. Ce tabela ze vsebuje podvojene ID-je,
+    indeksa ni mogoce ustvariti.
+    """
+    global schemaReady, unique_id_index
+    with schemaLock:
+        if schemaReady:
+            return
+        db.cur.execute(
             "select exists(select * from information_schema.tables where table_name=%s)",
-            (self.table_name,),
+            ("narocniki",),
         )
-        if self.cur.fetchone()[0]:
-            print("Table {0} already exists".format(self.table_name))
+        if db.cur.fetchone()[0]:
+            print("Table narocniki already exists")
         else:
-            self.cur.execute(
+            db.cur.execute(
                 """CREATE TABLE narocniki (
                                 id INT NOT NULL,
                                 ime CHAR(20),
@@ -242,6 +975,504 @@ class Narocnik(Resource):
                                 telefonska_stevilka CHAR(20)
                              )"""
             )
+        db.commit()
+        unique_id_index = has_unique_id_index(db)
+        try:
+            if not unique_id_index:
+                db.cur.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS narocniki_id_key ON narocniki (id)"
+                )
+                db.commit()
+                unique_id_index = True
+        except pg.Error as e:
+            db.rollback()
+            # Ob hkratnem zagonu vec podov indeks morda ustvari drug pod in ta dobi napako
+            unique_id_index = has_unique_id_index(db)
+            if not unique_id_index:
+                l.error(
+                    "Unikatnega indeksa nad narocniki.id ni mogoce ustvariti: %s" % str(e),
+                    extra={
+                        "name_of_service": "Uporabniki",
+                        "crud_method": None,
+                        "directions": None,
+                        "ip_node": socket.gethostbyname(socket.gethostname()),
+                        "status": "fail",
+                        "http_code": None,
+                    },
+                )
+        schemaReady = True
+
+
+def get_db():
+    if "db" not in flask_g:
+        try:
+            db = Database(get_connection_pool())
+        except pg_pool.PoolError:
+            abort(503, "Ni prostih povezav z bazo")
+        try:
+            ensure_schema(db)
+        except Exception:
+            db.release()
+            raise
+        flask_g.db = db
+    return flask_g.db
+
+
+@app.teardown_request
+def release_db(exc):
+    db = flask_g.pop("db", None)
+    if db is not None:
+        db.release()
+
+
+class RatingBuffer:
+    """
+    Medpomnilnik posodobitev ocen: posodobitve istega narocnika se zdruzijo, nit pa jih
+    vsak interval ali ob polnem paketu zapise z enim stavkom posodobi_ocene. Ob napakah
+    povezave se paket vrne v medpomnilnik in ponovi z narascajocim zamikom, ob napakah
+    v podatkih pa se paket zapise po vrsticah in zavrnjene posodobitve zavrzejo.
+    """
+
+    MAX_BACKOFF = 30.0
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        # ID narocnika -> [nastavi, vrednost]
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()
+        self.full = threading.Event()
+        self.stopped = False
+        self.backoff = 0.0
+        self.retryAt = 0.0
+        self.flusher = threading.Thread(target=self.run, daemon=True)
+        self.flusher.start()
+
+    @staticmethod
+    def merge(pending, id, nastavi, vrednost):
+        entry = pending.get(id)
+        if entry is None or nastavi:
+            pending[id] = [nastavi, vrednost]
+        else:
+            # Povecanje po nastavitvi ali po povecanju se pristeje cakajoci vrednosti.
+            # Ocena v bazi ne preseze MAX_OCENA, zato vecje povecanje ne spremeni rezultata,
+            # omejitev pa zdruzeno vrednost obdrzi v obsegu bigint
+            entry[1] = max(-2 * MAX_OCENA, min(2 * MAX_OCENA, entry[1] + vrednost))
+
+    def add(self, id, nastavi, vrednost):
+        """
+        Doda posodobitev v medpomnilnik. Po zaustavitvi je ne bi zapisal nihce vec,
+        zato vrne False in posodobitev mora zapisati klicatelj.
+        """
+        with self.lock:
+            if self.stopped:
+                return False
+            self.merge(self.pending, id, nastavi, vrednost)
+            size = len(self.pending)
+        ocenVCakanju.set(size)
+        # Med zamikom po neuspelem zapisu poln paket ne sprozi novega poskusa
+        if size >= self.batch_size and monotonic() >= self.retryAt:
+            self.full.set()
+        return True
+
+    def run(self):
+        while not self.stopped:
+            self.full.wait(self.interval)
+            self.full.clear()
+            if monotonic() >= self.retryAt:
+                self.flush()
+
+    def write(self, batch):
+        ids = list(batch)
+        db = Database(get_connection_pool())
+        try:
+            rows = db.fetchall(
+                "posodobi_ocene",
+                (
+                    ids,
+                    [batch[id][0] for id in ids],
+                    [batch[id][1] for id in ids],
+                ),
+            )
+            db.commit()
+        finally:
+            db.release()
+        return rows
+
+    def write_each(self, batch):
+        """
+        Zapise posodobitve posamezno, da napaka v podatkih enega narocnika ne ustavi
+        ostalih. Posodobitve, ki jih baza zavrne, se zavrzejo.
+        """
+        rows = []
+        ids = list(batch)
+        for n, id in enumerate(ids):
+            try:
+                rows += self.write({id: batch[id]})
+            except TRANSIENT_ERRORS as e:
+                self.retry({i: batch[i] for i in ids[n:]}, e)
+                break
+            except pg.Error as e:
+                l.error(
+                    "Posodobitev ocene narocnika z ID %s zavrzena: %s" % (str(id), str(e)),
+                    extra={
+                        "name_of_service": "Uporabniki",
+                        "crud_method": "put",
+                        "directions": "out",
+                        "ip_node": socket.gethostbyname(socket.gethostname()),
+                        "status": "fail",
+                        "http_code": None,
+                    },
+                )
+        return rows
+
+    def retry(self, batch, e):
+        # Neuspel paket vrni v medpomnilnik pred novejse posodobitve in pocakaj
+        with self.lock:
+            newer, self.pending = self.pending, batch
+            for id, (nastavi, vrednost) in newer.items():
+                self.merge(self.pending, id, nastavi, vrednost)
+            ocenVCakanju.set(len(self.pending))
+        self.backoff = min(max(self.backoff * 2, self.interval), self.MAX_BACKOFF)
+        self.retryAt = monotonic() + self.backoff
+        l.error(
+            "Zapis %d ocen ni uspel, ponovitev cez %.1f s: %s"
+            % (len(batch), self.backoff, str(e)),
+            extra={
+                "name_of_service": "Uporabniki",
+                "crud_method": "put",
+                "directions": "out",
+                "ip_node": socket.gethostbyname(socket.gethostname()),
+                "status": "fail",
+                "http_code": None,
+            },
+        )
+
+    def flush(self):
+        with self.flushLock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+            ocenVCakanju.set(0)
+            if not batch:
+                return 0
+            try:
+                rows = self.write(batch)
+            except TRANSIENT_ERRORS as e:
+                self.retry(batch, e)
+                return 0
+            except pg.Error:
+                rows = self.write_each(batch)
+            else:
+                self.backoff = 0.0
+                self.retryAt = 0.0
+            for id, ocena in rows:
+                snapshot.set_ocena(id, ocena)
+            return len(rows)
+
+    def close(self):
+        # Pod kljucavnico, da vsak add bodisi pride v zadnji paket bodisi vrne False
+        with self.lock:
+            self.stopped = True
+        self.full.set()
+        self.flusher.join()
+        self.flush()
+
+
+ocenVCakanju = Gauge("Ocene_v_cakanju", "Število nezapisanih posodobitev ocen")
+# Napake, po katerih ima ponovni poskus smisel (povezava, iztek casa, poln bazen)
+TRANSIENT_ERRORS = (pg.OperationalError, pg.InterfaceError, pg_pool.PoolError)
+ratings = None
+
+
+class VrsticaNarocnika:
+    __slots__ = (
+        "id",
+        "ime",
+        "priimek",
+        "ocena",
+        "uporabnisko_ime",
+        "telefonska_stevilka",
+    )
+
+    def __init__(self, id, ime, priimek, ocena, uporabnisko_ime, telefonska_stevilka):
+        self.id = id
+        self.ime = ime
+        self.priimek = priimek
+        self.ocena = ocena
+        self.uporabnisko_ime = uporabnisko_ime
+        self.telefonska_stevilka = telefonska_stevilka
+
+
+class SnapshotColumns:
+    """
+    Stolpci posnetka: ID-ji in ocene v tipiziranih tabelah, nizi v seznamih in
+    preslikava ID -> polozaj. Vse metode klice SubscriberSnapshot pod svojo kljucavnico,
+    razen pri gradnji novih stolpcev, ki jih se nihce drug ne vidi.
+    """
+
+    # Ocene, ki niso cela stevila, se v tabeli ocen hranijo kot -1 (niso na lestvici)
+    NI_OCENE = -1
+
+    def __init__(self):
+        self.ids = array("q")
+        self.ocene = array("q")
+        # ID -> izvirno besedilo ocene, ki ni celo stevilo
+        self.ocenaText = {}
+        self.ime = []
+        self.priimek = []
+        self.uporabnisko_ime = []
+        self.telefonska_stevilka = []
+        # ID -> polozaj v stolpcih
+        self.index = {}
+        # Povecan ob vsaki spremembi ocen ali polozajev, razveljavi shranjeno lestvico
+        self.version = 0
+        self.order = None
+        self.orderVersion = -1
+
+    def _set_ocena(self, i, ocena):
+        ocena = (ocena or "").strip()
+        try:
+            self.ocene[i] = int(ocena)
+            self.ocenaText.pop(self.ids[i], None)
+        except (ValueError, OverflowError):
+            self.ocene[i] = self.NI_OCENE
+            self.ocenaText[self.ids[i]] = ocena
+        self.version += 1
+
+    def upsert(self, id, ime, priimek, ocena, uporabnisko_ime, telefonska_stevilka):
+        i = self.index.get(id)
+        if i is None:
+            i = len(self.ids)
+            self.index[id] = i
+            self.ids.append(id)
+            self.ocene.append(0)
+            self.ime.append(None)
+            self.priimek.append(None)
+            self.uporabnisko_ime.append(None)
+            self.telefonska_stevilka.append(None)
+        # Imena in priimki se pogosto ponavljajo, zato si vrstice delijo iste nize
+        self.ime[i] = sys.intern((ime or "").strip())
+        self.priimek[i] = sys.intern((priimek or "").strip())
+        self.uporabnisko_ime[i] = (uporabnisko_ime or "").strip()
+        self.telefonska_stevilka[i] = (telefonska_stevilka or "").strip()
+        self._set_ocena(i, ocena)
+
+    def update(self, id, attribute, value):
+        i = self.index.get(id)
+        if i is None:
+            return
+        if attribute == "ocena":
+            self._set_ocena(i, value)
+        elif attribute in ("ime", "priimek"):
+            getattr(self, attribute)[i] = sys.intern((value or "").strip())
+        else:
+            getattr(self, attribute)[i] = (value or "").strip()
+
+    def delete(self, id):
+        i = self.index.pop(id, None)
+        if i is None:
+            return
+        self.ocenaText.pop(id, None)
+        # Zadnjo vrstico premakni na izbrisano mesto
+        last = len(self.ids) - 1
+        for column in (
+            self.ids,
+            self.ocene,
+            self.ime,
+            self.priimek,
+            self.uporabnisko_ime,
+            self.telefonska_stevilka,
+        ):
+            column[i] = column[last]
+            column.pop()
+        if i != last:
+            self.index[self.ids[i]] = i
+        self.version += 1
+
+    def ocena(self, i):
+        if self.ocene[i] == self.NI_OCENE:
+            return self.ocenaText.get(self.ids[i], str(self.NI_OCENE))
+        return str(self.ocene[i])
+
+    def row(self, i):
+        return VrsticaNarocnika(
+            self.ids[i],
+            self.ime[i],
+            self.priimek[i],
+            self.ocena(i),
+            self.uporabnisko_ime[i],
+            self.telefonska_stevilka[i],
+        )
+
+
+class SubscriberSnapshot:
+    """
+    Stolpcni posnetek tabele narocniki v pomnilniku. Pisalne poti posnetek sproti
+    posodabljajo, po max_age sekundah pa se ponovno nalozi iz baze, da zajame spremembe
+    drugih podov. Kljucavnica se drzi le za kratke operacije: nalaganje gradi nove
+    stolpce brez nje, branja pa pod njo le kopirajo stolpce.
+    """
+
+    NI_OCENE = SnapshotColumns.NI_OCENE
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.columns = SnapshotColumns()
+        self.loaded = None
+        # Spremembe med gradnjo novih stolpcev, ki se ponovijo pred zamenjavo
+        self.journal = None
+
+    @property
+    def building(self):
+        return self.journal is not None
+
+    def stale(self, max_age):
+        return self.loaded is None or (
+            max_age > 0 and monotonic() - self.loaded > max_age
+        )
+
+    def refresh(self, max_age, fetch_rows):
+        with self.lock:
+            if not self.stale(max_age) or self.building:
+                return
+            self.journal = []
+        try:
+            columns = SnapshotColumns()
+            for row in fetch_rows():
+                columns.upsert(*row)
+        except Exception:
+            with self.lock:
+                self.journal = None
+            raise
+        with self.lock:
+            # Vse spremembe so absolutne vrednosti, zato je ponovitev ze zajetih varna
+            for method, args in self.journal:
+                getattr(columns, method)(*args)
+            self.columns = columns
+            self.loaded = monotonic()
+            self.journal = None
+
+    def _write(self, method, *args):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.append((method, args))
+            if self.loaded is not None:
+                getattr(self.columns, method)(*args)
+
+    def upsert(self, row):
+        self._write("upsert", *row)
+
+    def update(self, id, attribute, value):
+        self._write("update", id, attribute, value)
+
+    def set_ocena(self, id, ocena):
+        self._write("update", id, "ocena", ocena)
+
+    def delete(self, id):
+        self._write("delete", id)
+
+    def rows(self):
+        with self.lock:
+            c = self.columns
+            ids, ocene = c.ids[:], c.ocene[:]
+            ime, priimek = c.ime[:], c.priimek[:]
+            uporabnisko_ime = c.uporabnisko_ime[:]
+            telefonska_stevilka = c.telefonska_stevilka[:]
+            ocenaText = dict(c.ocenaText)
+        ocene = [
+            ocenaText.get(id, str(self.NI_OCENE))
+            if ocena == self.NI_OCENE
+            else str(ocena)
+            for id, ocena in zip(ids, ocene)
+        ]
+        return list(
+            map(
+                VrsticaNarocnika,
+                ids,
+                ime,
+                priimek,
+                ocene,
+                uporabnisko_ime,
+                telefonska_stevilka,
+            )
+        )
+
+    def ranking(self):
+        """
+        Narocniki z oceno, urejeni po padajoci oceni, kot (mesto, id, ime, priimek, ocena).
+        Vrstni red se shrani in ponovno uredi le po spremembi ocen ali polozajev.
+        """
+        with self.lock:
+            c = self.columns
+            version = c.version
+            order = c.order if c.orderVersion == version else None
+            ids, ocene = c.ids[:], c.ocene[:]
+            ime, priimek = c.ime[:], c.priimek[:]
+        if order is None:
+            order = array(
+                "q",
+                sorted(
+                    (i for i in range(len(ocene)) if ocene[i] != self.NI_OCENE),
+                    key=ocene.__getitem__,
+                    reverse=True,
+                ),
+            )
+            with self.lock:
+                if self.columns is c and c.version == version:
+                    c.order, c.orderVersion = order, version
+        return [
+            (mesto, ids[i], ime[i], priimek[i], str(ocene[i]))
+            for mesto, i in enumerate(order, start=1)
+        ]
+
+    def random_row(self):
+        with self.lock:
+            c = self.columns
+            if not c.ids:
+                return None
+            return c.row(random.randrange(len(c.ids)))
+
+
+snapshot = SubscriberSnapshot()
+
+
+def get_snapshot():
+    """
+    Vrne posnetek, ce je vklopljen, in ga po potrebi nalozi iz baze. Dokler prvo
+    nalaganje ni koncano ali ce nad id ni unikatnega indeksa, vrne None.
+    """
+    if not settings.snapshot_enabled:
+        return None
+    if snapshot.stale(settings.snapshot_max_age) and not snapshot.building:
+        db = get_db()
+        if not unique_id_index:
+            return None
+        snapshot.refresh(
+            settings.snapshot_max_age,
+            lambda: db.fetchall("vsi_narocniki"),
+        )
+    if snapshot.loaded is None:
+        return None
+    return snapshot
+
+
+class DatabaseResource(Resource):
+    """
+    Resource z dostopom do baze: povezava se iz bazena vzame sele ob prvi poizvedbi,
+    zato zahteve, ki jim odgovori posnetek, bazena ne obremenijo.
+    """
+
+    @property
+    def db(self):
+        return get_db()
+
+
+class Narocnik(DatabaseResource):
+    razred_obremenitve = "tocka"
+
+    def __init__(self, *args, **kwargs):
+        self.table_name = "narocniki"
 
         self.parser = reqparse.RequestParser()
         self.parser.add_argument("id", type=int)
@@ -273,8 +1504,7 @@ class Narocnik(Resource):
                 "http_code": None,
             },
         )
-        self.cur.execute("SELECT * FROM narocniki WHERE id = %s" % str(id))
-        row = self.cur.fetchall()
+        row = self.db.fetchall("narocnik_po_id", (id,))
 
         if len(row) == 0:
             l.warning(
@@ -336,8 +1566,7 @@ class Narocnik(Resource):
                 "http_code": None,
             },
         )
-        self.cur.execute("SELECT * FROM narocniki WHERE id = %s" % str(id))
-        row = self.cur.fetchall()
+        row = self.db.fetchall("narocnik_po_id", (id,))
 
         if len(row) == 0:
             l.warning(
@@ -356,12 +1585,11 @@ class Narocnik(Resource):
         args = self.parser.parse_args()
         attribute = args["atribut"]
         value = args["vrednost"]
-        self.cur.execute(
-            """UPDATE {0} SET {1} = '{2}' WHERE id = {3}""".format(
-                self.table_name, attribute, value, id
-            )
-        )
-        self.conn.commit()
+        if attribute not in narocnikiPolja or attribute == "id":
+            abort(400, "Atribut %s ne obstaja" % attribute)
+        self.db.execute("posodobi_%s" % attribute, (value, id))
+        self.db.commit()
+        snapshot.update(id, attribute, value)
 
         d = {}
         for el, k in zip(row[0], narocnikiPolja):
@@ -408,13 +1636,9 @@ class Narocnik(Resource):
                 "http_code": None,
             },
         )
-        self.cur.execute("SELECT * FROM narocniki")
-        rows = self.cur.fetchall()
-        ids = []
-        for row in rows:
-            ids.append(row[0])
+        deleted = self.db.fetchone("izbrisi_narocnika", (id,))
 
-        if id not in ids:
+        if deleted is None:
             l.warning(
                 "Narocnik z ID %s ni bil najden in ne bo izbrisan" % str(id),
                 extra={
@@ -428,8 +1652,8 @@ class Narocnik(Resource):
             )
             abort(404, "Uporabnik ni bil najden!")
         else:
-            self.cur.execute("DELETE FROM narocniki WHERE id = %s" % str(id))
-            self.conn.commit()
+            self.db.commit()
+            snapshot.delete(id)
 
         g.dec()
 
@@ -448,28 +1672,11 @@ class Narocnik(Resource):
         return 204
 
 
-class ListNarocnikov(Resource):
+class ListNarocnikov(DatabaseResource):
+    razred_obremenitve = {"get": "pregled", "post": "tocka"}
+
     def __init__(self, *args, **kwargs):
         self.table_name = "narocniki"
-        self.conn = connect_to_database()
-        self.cur = self.conn.cursor()
-        self.cur.execute(
-            "select exists(select * from information_schema.tables where table_name=%s)",
-            (self.table_name,),
-        )
-        if self.cur.fetchone()[0]:
-            print("Table {0} already exists".format(self.table_name))
-        else:
-            self.cur.execute(
-                """CREATE TABLE narocniki (
-                                id INT NOT NULL,
-                                ime CHAR(20),
-                                priimek CHAR(20),
-                                ocena CHAR(20),
-                                uporabnisko_ime CHAR(20),
-                                telefonska_stevilka CHAR(20)
-                             )"""
-            )
 
         self.parser = reqparse.RequestParser()
         self.parser.add_argument(
@@ -515,27 +1722,30 @@ class ListNarocnikov(Resource):
                 "http_code": None,
             },
         )
-        self.cur.execute("SELECT * FROM narocniki")
-        rows = self.cur.fetchall()
-        ds = {}
-        i = 0
-        for row in rows:
-            ds[i] = {}
-            for el, k in zip(row, narocnikiPolja):
-                ds[i][k] = el
-            i += 1
+        posnetek = get_snapshot()
+        if posnetek is not None:
+            narocniki = posnetek.rows()
+        else:
+            rows = self.db.fetchall("vsi_narocniki")
+            ds = {}
+            i = 0
+            for row in rows:
+                ds[i] = {}
+                for el, k in zip(row, narocnikiPolja):
+                    ds[i][k] = el
+                i += 1
 
-        narocniki = []
-        for d in ds:
-            narocnik = NarocnikModel(
-                id=ds[d]["id"],
-                ime=ds[d]["ime"].strip(),
-                priimek=ds[d]["priimek"].strip(),
-                ocena=ds[d]["ocena"].strip(),
-                uporabnisko_ime=ds[d]["uporabnisko_ime"].strip(),
-                telefonska_stevilka=ds[d]["telefonska_stevilka"].strip(),
-            )
-            narocniki.append(narocnik)
+            narocniki = []
+            for d in ds:
+                narocnik = NarocnikModel(
+                    id=ds[d]["id"],
+                    ime=ds[d]["ime"].strip(),
+                    priimek=ds[d]["priimek"].strip(),
+                    ocena=ds[d]["ocena"].strip(),
+                    uporabnisko_ime=ds[d]["uporabnisko_ime"].strip(),
+                    telefonska_stevilka=ds[d]["telefonska_stevilka"].strip(),
+                )
+                narocniki.append(narocnik)
 
         l.info(
             "Vrni vse narocnike",
@@ -556,9 +1766,9 @@ class ListNarocnikov(Resource):
     @ns.doc("Dodaj narocnika")
     def post(self):
         """
-        Dodaj novega narocnika
+        Dodaj novega narocnika. Ponovljena zahteva z istim Idempotency-Key
+        ali z enakimi podatki vrne obstojecega narocnika s kodo 200.
         """
-        g.inc()
         l.info(
             "Dodaj novega narocnika",
             extra={
@@ -571,24 +1781,69 @@ class ListNarocnikov(Resource):
             },
         )
         args = self.parser.parse_args()
-        values = []
-        for a in args.values():
-            values.append(a)
-        self.cur.execute(
-            """INSERT INTO {0} (id, ime, priimek, ocena, uporabnisko_ime, telefonska_stevilka)
-                VALUES ({1}, '{2}', '{3}', '{4}', '{5}', '{6}')""".format(
-                "narocniki", *values
-            )
-        )
-        self.conn.commit()
-        narocnik = NarocnikModel(
-            id=args["id"],
-            ime=args["ime"].strip(),
-            priimek=args["priimek"].strip(),
-            ocena=args["ocena"].strip(),
-            uporabnisko_ime=args["uporabnisko_ime"].strip(),
-            telefonska_stevilka=args["telefonska_stevilka"].strip(),
+        values = (
+            args["id"],
+            args["ime"].strip(),
+            args["priimek"].strip(),
+            args["ocena"].strip(),
+            args["uporabnisko_ime"].strip(),
+            (args["telefonska_stevilka"] or "").strip(),
         )
+        payload = json.dumps(values, ensure_ascii=False)
+
+        key = request.headers.get("Idempotency-Key")
+        if key:
+            entry = idempotency.begin(key, payload)
+            if entry is not None:
+                same_payload, id = entry
+                if not same_payload:
+                    abort(422, "Idempotency-Key je bil uporabljen z drugimi podatki")
+                if id is IdempotencyStore.IN_PROGRESS:
+                    abort(409, "Zahteva s tem Idempotency-Key se se obdeluje")
+                return self.replay(id)
+
+        # Vsaka napaka do zakljucka (tudi 409 ali iztek casa) sprosti kljuc, sicer bi
+        # ponovitve z istim Idempotency-Key do izteka TTL dobivale 409
+        try:
+            # Prvi get_db v procesu pripravi shemo in nastavi unique_id_index
+            db = self.db
+            if unique_id_index:
+                created = db.fetchone("dodaj_narocnika", values) is not None
+            else:
+                # Brez unikatnega indeksa vstavljanja istega ID-ja serializiramo s kljucavnico
+                db.execute("zakleni_id", (args["id"],))
+                created = db.fetchone("dodaj_narocnika_brez_indeksa", values) is not None
+            db.commit()
+
+            if not created:
+                if db.fetchone("primerjaj_narocnika", (args["id"],)) != values:
+                    l.warning(
+                        "Narocnik z ID %s ze obstaja" % str(args["id"]),
+                        extra={
+                            "name_of_service": "Uporabniki",
+                            "crud_method": "post",
+                            "directions": "out",
+                            "ip_node": socket.gethostbyname(socket.gethostname()),
+                            "status": "fail",
+                            "http_code": 409,
+                        },
+                    )
+                    abort(409, "Narocnik s tem ID ze obstaja")
+
+            if key:
+                idempotency.finish(key, payload, args["id"])
+        except Exception:
+            if key:
+                idempotency.cancel(key)
+            if "db" in flask_g:
+                flask_g.db.rollback()
+            raise
+        if not created:
+            return self.replay(args["id"])
+
+        g.inc()
+        snapshot.upsert(values)
+        narocnik = NarocnikModel(*values)
 
         l.info(
             "Nov narocnik dodan",
@@ -604,29 +1859,44 @@ class ListNarocnikov(Resource):
 
         return narocnik, 201
 
+    def replay(self, id):
+        row = self.db.fetchone("narocnik_po_id", (id,))
+        if row is None:
+            abort(404, "Uporabnik ni bil najden!")
+
+        d = {}
+        for el, k in zip(row, narocnikiPolja):
+            d[k] = el
+
+        narocnik = NarocnikModel(
+            id=d["id"],
+            ime=d["ime"].strip(),
+            priimek=d["priimek"].strip(),
+            ocena=d["ocena"].strip(),
+            uporabnisko_ime=d["uporabnisko_ime"].strip(),
+            telefonska_stevilka=d["telefonska_stevilka"].strip(),
+        )
+
+        l.info(
+            "Vrni obstojecega narocnika z ID %s" % str(id),
+            extra={
+                "name_of_service": "Uporabniki",
+                "crud_method": "post",
+                "directions": "out",
+                "ip_node": socket.gethostbyname(socket.gethostname()),
+                "status": "success",
+                "http_code": 200,
+            },
+        )
+
+        return narocnik, 200
+
+
+class LestvicaUporabnikov(DatabaseResource):
+    razred_obremenitve = "pregled"
 
-class LestvicaUporabnikov(Resource):
     def __init__(self, *args, **kwargs):
         self.table_name = "narocniki"
-        self.conn = connect_to_database()
-        self.cur = self.conn.cursor()
-        self.cur.execute(
-            "select exists(select * from information_schema.tables where table_name=%s)",
-            (self.table_name,),
-        )
-        if self.cur.fetchone()[0]:
-            print("Table {0} already exists".format(self.table_name))
-        else:
-            self.cur.execute(
-                """CREATE TABLE narocniki (
-                                id INT NOT NULL,
-                                ime CHAR(20),
-                                priimek CHAR(20),
-                                ocena CHAR(20),
-                                uporabnisko_ime CHAR(20),
-                                telefonska_stevilka CHAR(20)
-                             )"""
-            )
         super(LestvicaUporabnikov, self).__init__(*args, **kwargs)
 
     @ns.marshal_list_with(oceneApiModel)
@@ -646,8 +1916,33 @@ class LestvicaUporabnikov(Resource):
                 "http_code": None,
             },
         )
-        self.cur.execute("SELECT * FROM narocniki")
-        rows = self.cur.fetchall()
+        posnetek = get_snapshot()
+        if posnetek is not None:
+            lestvica = [
+                OcenaModel(
+                    id=id, ime=ime, priimek=priimek, ocena=ocena, mesto="%d.mesto" % mesto
+                )
+                for mesto, id, ime, priimek, ocena in posnetek.ranking()
+            ]
+        else:
+            lestvica = self.ranking_from_database()
+
+        l.info(
+            "Vrni lestvico narocnikov",
+            extra={
+                "name_of_service": "Ocene",
+                "crud_method": "get",
+                "directions": "out",
+                "ip_node": socket.gethostbyname(socket.gethostname()),
+                "status": "success",
+                "http_code": 200,
+            },
+        )
+
+        return {"narocniki": lestvica}, 200
+
+    def ranking_from_database(self):
+        rows = self.db.fetchall("vsi_narocniki")
         ds = {}
         i = 0
         for row in rows:
@@ -678,26 +1973,14 @@ class LestvicaUporabnikov(Resource):
                 lestvica.append(ocena)
                 i += 1
 
-        l.info(
-            "Vrni lestvico narocnikov",
-            extra={
-                "name_of_service": "Ocene",
-                "crud_method": "get",
-                "directions": "out",
-                "ip_node": socket.gethostbyname(socket.gethostname()),
-                "status": "success",
-                "http_code": 200,
-            },
-        )
+        return lestvica
 
-        return {"narocniki": lestvica}, 200
 
+class Nagrajenec(DatabaseResource):
+    razred_obremenitve = "pregled"
 
-class Nagrajenec(Resource):
     def __init__(self, *args, **kwargs):
         self.table_name = "narocniki"
-        self.conn = connect_to_database()
-        self.cur = self.conn.cursor()
         self.nagrade = [
             "cokolada",
             "zastonj vožnja",
@@ -708,23 +1991,6 @@ class Nagrajenec(Resource):
             "60% popusta na naslednji prevoz",
             "počitnice v Maroku",
         ]
-        self.cur.execute(
-            "select exists(select * from information_schema.tables where table_name=%s)",
-            (self.table_name,),
-        )
-        if self.cur.fetchone()[0]:
-            print("Table {0} already exists".format(self.table_name))
-        else:
-            self.cur.execute(
-                """CREATE TABLE narocniki (
-                                id INT NOT NULL,
-                                ime CHAR(20),
-                                priimek CHAR(20),
-                                ocena CHAR(20),
-                                uporabnisko_ime CHAR(20),
-                                telefonska_stevilka CHAR(20)
-                             )"""
-            )
         super(Nagrajenec, self).__init__(*args, **kwargs)
 
     @ns.marshal_list_with(nagradaApiModel)
@@ -744,23 +2010,31 @@ class Nagrajenec(Resource):
                 "http_code": None,
             },
         )
-        self.cur.execute("SELECT * FROM narocniki")
-        rows = self.cur.fetchall()
-        ds = {}
-        i = 0
-        for row in rows:
-            ds[i] = {}
-            for el, k in zip(row, narocnikiPolja):
-                ds[i][k] = el
-            i += 1
-
         na = random.choice(self.nagrade)
-        # Uredi jih po uspešnosti
-        d = random.choice(list(ds.values()))
+        posnetek = get_snapshot()
+        if posnetek is not None:
+            vrstica = posnetek.random_row()
+            if vrstica is None:
+                abort(404, "Ni narocnikov")
+            nagrada = NagradaModel(
+                id=vrstica.id, ime=vrstica.ime, priimek=vrstica.priimek, nagrada=na
+            )
+        else:
+            rows = self.db.fetchall("vsi_narocniki")
+            ds = {}
+            i = 0
+            for row in rows:
+                ds[i] = {}
+                for el, k in zip(row, narocnikiPolja):
+                    ds[i][k] = el
+                i += 1
 
-        nagrada = NagradaModel(
-            id=d["id"], ime=d["ime"].strip(), priimek=d["priimek"].strip(), nagrada=na
-        )
+            # Uredi jih po uspešnosti
+            d = random.choice(list(ds.values()))
+
+            nagrada = NagradaModel(
+                id=d["id"], ime=d["ime"].strip(), priimek=d["priimek"].strip(), nagrada=na
+            )
 
         l.info(
             "Vrni nagrajenca",
@@ -777,27 +2051,420 @@ class Nagrajenec(Resource):
         return nagrada, 200
 
 
-health = HealthCheck()
-envdump = EnvironmentDump()
-health.add_check(check_database_connection)
-envdump.add_section("application", application_data)
+def ocena_vrednost(value):
+    value = int(value)
+    if not -MAX_OCENA <= value <= MAX_OCENA:
+        raise ValueError("(med -%d in %d)" % (MAX_OCENA, MAX_OCENA))
+    return value
+
+
+class OcenaNarocnika(DatabaseResource):
+    razred_obremenitve = "tocka"
+
+    def __init__(self, *args, **kwargs):
+        self.parser = reqparse.RequestParser()
+        self.parser.add_argument(
+            "vrednost",
+            type=ocena_vrednost,
+            required=True,
+            help="Vrednost ocene mora biti celo stevilo",
+        )
+
+        super(OcenaNarocnika, self).__init__(*args, **kwargs)
+
+    @ns.expect(posodobiOcenoModel)
+    @ns.response(202, "Posodobitev ocene sprejeta")
+    @ns.response(404, "Narocnik ni najden")
+    @ns.doc("Povecaj oceno narocnika")
+    def post(self, id):
+        """
+        Povecaj oceno narocnika za vrednost (lahko je negativna)
+        """
+        return self.update(id, False, "post")
+
+    @ns.expect(posodobiOcenoModel)
+    @ns.response(202, "Posodobitev ocene sprejeta")
+    @ns.response(404, "Narocnik ni najden")
+    @ns.doc("Nastavi oceno narocnika")
+    def put(self, id):
+        """
+        Nastavi oceno narocnika na vrednost
+        """
+        return self.update(id, True, "put")
+
+    def update(self, id, nastavi, method):
+        l.info(
+            "Posodobi oceno narocnika z ID %s" % str(id),
+            extra={
+                "name_of_service": "Ocene",
+                "crud_method": method,
+                "directions": "in",
+                "ip_node": socket.gethostbyname(socket.gethostname()),
+                "status": None,
+                "http_code": None,
+            },
+        )
+        args = self.parser.parse_args()
+
+        # Paketni nacin: ocena bo zapisana ob naslednjem praznjenju medpomnilnika.
+        # Ko je medpomnilnik ob izhodu ze zaustavljen, se zapise takoj.
+        if settings.rating_durability != "sync" and ratings.add(
+            id, nastavi, args["vrednost"]
+        ):
+            return {"id": id}, 202
+
+        db = self.db
+        row = db.fetchone("posodobi_ocene", ([id], [nastavi], [args["vrednost"]]))
+        db.commit()
+        if row is None:
+            l.warning(
+                "Narocnik z ID %s ne obstaja" % str(id),
+                extra={
+                    "name_of_service": "Ocene",
+                    "crud_method": method,
+                    "directions": "out",
+                    "ip_node": socket.gethostbyname(socket.gethostname()),
+                    "status": "fail",
+                    "http_code": 404,
+                },
+            )
+            abort(404, "Uporabnik ni bil najden!")
+        snapshot.set_ocena(row[0], row[1])
+
+        l.info(
+            "Ocena narocnika z ID %s posodobljena" % str(id),
+            extra={
+                "name_of_service": "Ocene",
+                "crud_method": method,
+                "directions": "out",
+                "ip_node": socket.gethostbyname(socket.gethostname()),
+                "status": "success",
+                "http_code": 200,
+            },
+        )
+
+        return {"id": row[0], "ocena": row[1]}, 200
+
+
+izvozniStavki = {"csv": "izvoz_csv", "ndjson": "izvoz_ndjson"}
+izvozniTipi = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+class CopyStream:
+    """
+    Datoteki podoben objekt, ki ga polni copy_expert, prazni pa generator odgovora.
+    Vrstice zdruzuje v kose velikosti chunk_size, vrsta kosov je omejena, zato je
+    poraba pomnilnika konstantna ne glede na velikost tabele.
+    """
+
+    def __init__(self, chunk_size, queue_size, compress=False):
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(maxsize=queue_size)
+        self.buffer = bytearray()
+        self.cancelled = threading.Event()
+        # wbits=31 pomeni gzip glavo in nogo
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self, final=False):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+            if final:
+                data += self.compressor.flush()
+        if data:
+            self._put(data)
+
+    def _put(self, item):
+        # Blokiraj, dokler odjemalec ne prebere kosa, a se ustavi ob prekinitvi
+        while not self.cancelled.is_set():
+            try:
+                self.chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        raise IOError("Izvoz prekinjen")
+
+    def copy(self, db, name):
+        try:
+            db.copy(name, self)
+            self._flush(final=True)
+            self._put(None)
+        except Exception as e:
+            if not self.cancelled.is_set():
+                self._put(e)
+
+    def __iter__(self):
+        while True:
+            item = self.chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class IzvozNarocnikov(DatabaseResource):
+    razred_obremenitve = "izvoz"
+
+    def __init__(self, *args, **kwargs):
+        self.table_name = "narocniki"
+
+        self.parser = reqparse.RequestParser()
+        self.parser.add_argument(
+            "format",
+            type=str,
+            location="args",
+            default="csv",
+            choices=tuple(izvozniStavki),
+            help="Format izvoza je csv ali ndjson",
+        )
+        self.parser.add_argument(
+            "gzip", type=inputs.boolean, location="args", default=False
+        )
+
+        super(IzvozNarocnikov, self).__init__(*args, **kwargs)
+
+    @ns.doc("Izvozi vse narocnike", params={"format": "csv ali ndjson", "gzip": "true ali false"})
+    def get(self):
+        """
+        Pretocno izvozi vse narocnike v CSV ali NDJSON obliki
+        """
+        l.info(
+            "Izvozi vse narocnike",
+            extra={
+                "name_of_service": "Uporabniki",
+                "crud_method": "get",
+                "directions": "in",
+                "ip_node": socket.gethostbyname(socket.gethostname()),
+                "status": None,
+                "http_code": None,
+            },
+        )
+        args = self.parser.parse_args()
+        fmt = args["format"]
+        stream = CopyStream(
+            settings.export_chunk_size,
+            settings.export_queue_size,
+            compress=args["gzip"],
+        )
+        worker = threading.Thread(
+            target=stream.copy, args=(self.db, izvozniStavki[fmt]), daemon=True
+        )
+
+        def generate():
+            worker.start()
+            try:
+                for chunk in stream:
+                    yield chunk
+            finally:
+                if worker.is_alive():
+                    # Odjemalec je prekinil: brez preklica bi ROLLBACK ob sprostitvi
+                    # povezave prebral in zavrgel preostanek COPY toka iz baze
+                    self.db.conn.cancel()
+                stream.cancelled.set()
+                worker.join()
+            l.info(
+                "Izvoz narocnikov koncan",
+                extra={
+                    "name_of_service": "Uporabniki",
+                    "crud_method": "get",
+                    "directions": "out",
+                    "ip_node": socket.gethostbyname(socket.gethostname()),
+                    "status": "success",
+                    "http_code": 200,
+                },
+            )
+
+        filename = "narocniki.%s" % fmt
+        mimetype = izvozniTipi[fmt]
+        if args["gzip"]:
+            filename += ".gz"
+            mimetype = "application/gzip"
+
+        return Response(
+            stream_with_context(generate()),
+            status=200,
+            mimetype=mimetype,
+            headers={"Content-Disposition": "attachment; filename=%s" % filename},
+        )
+
+
+class Profiler(Resource):
+    def __init__(self, *args, **kwargs):
+        self.parser = reqparse.RequestParser()
+        self.parser.add_argument(
+            "delez", type=float, default=1.0, help="Delez profiliranih zahtev (0-1)"
+        )
+        self.parser.add_argument(
+            "trajanje",
+            type=float,
+            default=30.0,
+            help="Trajanje profiliranja v sekundah (0 pomeni do izklopa)",
+        )
+        self.getParser = reqparse.RequestParser()
+        self.getParser.add_argument(
+            "format",
+            type=str,
+            location="args",
+            default="json",
+            choices=("json", "collapsed"),
+            help="Format je json ali collapsed",
+        )
+
+        super(Profiler, self).__init__(*args, **kwargs)
+
+    @ns.doc("Vrni rezultate profiliranja", params={"format": "json ali collapsed"})
+    def get(self):
+        """
+        Vrni cas po koncnih tockah in funkcijah ali strnjene sklade za flame graph
+        """
+        require_admin()
+        args = self.getParser.parse_args()
+        if args["format"] == "collapsed":
+            return Response(profiler.collapsed(), status=200, mimetype="text/plain")
+        return profiler.summary(), 200
+
+    @ns.doc("Vklopi profiliranje")
+    def post(self):
+        """
+        Vklopi vzorcevalno profiliranje za delez zahtev in dolocen cas
+        """
+        require_admin()
+        args = self.parser.parse_args()
+        if not 0 < args["delez"] <= 1 or args["trajanje"] < 0:
+            abort(400, "Neveljaven delez ali trajanje")
+        profiler.start(args["delez"], args["trajanje"])
+        l.info(
+            "Profiliranje vklopljeno (delez %s, trajanje %s s)"
+            % (args["delez"], args["trajanje"]),
+            extra={
+                "name_of_service": "Uporabniki",
+                "crud_method": "post",
+                "directions": "in",
+                "ip_node": socket.gethostbyname(socket.gethostname()),
+                "status": "success",
+                "http_code": 200,
+            },
+        )
+        return profiler.summary(), 200
+
+    @ns.doc("Izklopi profiliranje")
+    def delete(self):
+        """
+        Izklopi profiliranje, zbrani rezultati ostanejo na voljo
+        """
+        require_admin()
+        profiler.stop()
+        return profiler.summary(), 200
+
+
+def init_app():
+    """
+    Nalozi nastavitve in pripravi komponente, ki jih uvoz modula ne ustvari:
+    dnevnik Fluent, nadzor sprejema, shrambo kljucev, profiler, medpomnilnik ocen in
+    zdravstvene preglede.
+    Povezave z bazo se odprejo sele ob prvi poizvedbi.
+    """
+    global settings, started, fluentHandler, admission, idempotency, profiler
+    global statementTimeouts, health, envdump, ratings
+    with startLock:
+        if started:
+            return
+        settings = Settings.load(os.path.join(app.root_path, "config.json"))
+        if settings.trusted_proxy_hops > 0:
+            app.wsgi_app = ProxyFix(app.wsgi_app, x_for=settings.trusted_proxy_hops)
+
+        logging.basicConfig(level=logging.INFO)
+        fluentHandler = handler.FluentHandler(
+            "Uporabniki", host=settings.fluent_ip, port=settings.fluent_port
+        )
+        fluentHandler.setFormatter(handler.FluentRecordFormatter(custom_format))
+        l.addHandler(fluentHandler)
+        atexit.register(fluentHandler.close)
+
+        l.info(
+            "Setting up Uporabniki App",
+            extra={
+                "name_of_service": "Uporabniki",
+                "crud_method": None,
+                "directions": None,
+                "ip_node": None,
+                "status": None,
+                "http_code": None,
+            },
+        )
+
+        admission = AdmissionControl(
+            limits={
+                "tocka": settings.max_inflight_tocka,
+                "pregled": settings.max_inflight_pregled,
+                "izvoz": settings.max_inflight_izvoz,
+            },
+            queue_size=settings.admission_queue_size,
+            queue_timeout=settings.admission_queue_timeout,
+            rate=settings.rate_limit_rate,
+            burst=settings.rate_limit_burst,
+            max_clients=settings.rate_limit_max_clients,
+        )
+        idempotency = IdempotencyStore(
+            ttl=settings.idempotency_ttl, max_keys=settings.idempotency_max_keys
+        )
+        statementTimeouts = {
+            "tocka": settings.statement_timeout_tocka,
+            "pregled": settings.statement_timeout_pregled,
+            "izvoz": settings.statement_timeout_izvoz,
+        }
+        profiler = SamplingProfiler(interval=settings.profiler_interval_ms / 1000)
+        if settings.rating_durability != "sync":
+            ratings = RatingBuffer(
+                interval=settings.rating_flush_interval_ms / 1000,
+                batch_size=settings.rating_batch_size,
+            )
+            # Registrirano po zapiranju dnevnika, zato se izvede pred njim
+            atexit.register(ratings.close)
+
+        health = HealthCheck()
+        envdump = EnvironmentDump()
+        health.add_check(check_database_connection)
+        envdump.add_section("application", application_data)
+
+        l.info(
+            "Uporabniki App pripravljen",
+            extra={
+                "name_of_service": "Uporabniki",
+                "crud_method": None,
+                "directions": None,
+                "ip_node": None,
+                "status": None,
+                "http_code": None,
+            },
+        )
+        started = True
+
+
+health = None
+envdump = None
 app.add_url_rule("/healthcheck", "healthcheck", view_func=lambda: health.run())
 app.add_url_rule("/environment", "environment", view_func=lambda: envdump.run())
 api.add_resource(ListNarocnikov, "/narocniki")
+api.add_resource(IzvozNarocnikov, "/narocniki/export")
 api.add_resource(LestvicaUporabnikov, "/lestvica")
 api.add_resource(Nagrajenec, "/loto")
 api.add_resource(Narocnik, "/narocniki/<int:id>")
-l.info(
-    "Uporabniki App pripravljen",
-    extra={
-        "name_of_service": "Uporabniki",
-        "crud_method": None,
-        "directions": None,
-        "ip_node": None,
-        "status": None,
-        "http_code": None,
-    },
-)
+api.add_resource(OcenaNarocnika, "/narocniki/<int:id>/ocena")
+api.add_resource(Profiler, "/admin/profiler", endpoint="profiler")
+
 
-app.run(host="0.0.0.0", port=5003)
-h.close()
+if __name__ == "__main__":
+    # SIGTERM (npr. ob ustavitvi poda) sprozi normalen izhod, da se izvedejo funkcije atexit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    init_app()
+    app.run(host="0.0.0.0", port=5003)
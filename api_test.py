@@ -1,6 +1,9 @@
 import unittest
 import requests
+import api
 import json
+import os
+import time
 
 class TestAPI(unittest.TestCase):
 
@@ -16,10 +19,62 @@ class TestAPI(unittest.TestCase):
         resp = requests.put(self.BASE + "/narocniki/3", {"atribut": "ime", "vrednost": "Teolina"})
         self.assertEqual(resp.status_code, 200)
 
+    def test_2_put_unknown_attribute(self):
+        resp = requests.put(self.BASE + "/narocniki/3", {"atribut": "id = 0; --", "vrednost": "x"})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_2_post_ocena(self):
+        resp = requests.post(self.BASE + "/narocniki/3/ocena", {"vrednost": 1})
+        self.assertIn(resp.status_code, (200, 202))
+
+    def test_2_put_ocena_out_of_range(self):
+        resp = requests.put(self.BASE + "/narocniki/3/ocena", {"vrednost": 10 ** 18})
+        self.assertEqual(resp.status_code, 400)
+
     def test_3_delete_narocnik(self):
         resp = requests.delete(self.BASE + "/narocniki/3")
         self.assertEqual(resp.status_code, 200)
 
+    def test_post_idempotency_key(self):
+        data = {"id": 4, "ime": "Janez", "priimek": "Novak", "ocena": "5", "uporabnisko_ime": "jn", "telefonska_stevilka": "123"}
+        headers = {"Idempotency-Key": "test-post-4"}
+        resp = requests.post(self.BASE + "/narocniki", data, headers=headers)
+        self.assertEqual(resp.status_code, 201)
+        resp = requests.post(self.BASE + "/narocniki", data, headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["id"], 4)
+        resp = requests.post(self.BASE + "/narocniki", dict(data, ime="Micka"), headers=headers)
+        self.assertEqual(resp.status_code, 422)
+        resp = requests.post(self.BASE + "/narocniki", dict(data, ime="Micka"))
+        self.assertEqual(resp.status_code, 409)
+        requests.delete(self.BASE + "/narocniki/4")
+
+    def test_export_csv(self):
+        resp = requests.get(self.BASE + "/narocniki/export", params={"format": "csv"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.text.startswith("id,ime,priimek,ocena"))
+
+    def test_export_ndjson_gzip(self):
+        resp = requests.get(self.BASE + "/narocniki/export", params={"format": "ndjson", "gzip": "true"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Content-Type"], "application/gzip")
+
+    def test_profiler_requires_token(self):
+        resp = requests.get(self.BASE + "/admin/profiler")
+        self.assertEqual(resp.status_code, 403)
+
+    def test_rate_limit(self):
+        statuses = []
+        for _ in range(200):
+            resp = requests.get(self.BASE + "/narocniki/1")
+            statuses.append(resp.status_code)
+            if resp.status_code == 429:
+                self.assertGreaterEqual(int(resp.headers["Retry-After"]), 1)
+                break
+        self.assertIn(429, statuses)
+        # Pocakaj, da se zetoni napolnijo za ostale teste
+        time.sleep(3)
+
     def test_healthcheck(self):
         resp = requests.get(self.BASE + "/healthcheck")
         self.assertIsNotNone(resp)
@@ -28,5 +83,244 @@ class TestAPI(unittest.TestCase):
         resp = requests.get(self.BASE + "/environment")
         self.assertIsNotNone(resp)
 
+ROWS = [
+    (1, "Ana", "Novak", "5", "an", "111"),
+    (2, "Bor", "Kos", "9", "bk", "222"),
+    (3, "Cene", "Lah", "-1", "cl", "333"),
+    (4, "Dora", "Mak", "abc", "dm", "444"),
+    (5, "Eva", "Nos", "7", "en", "555"),
+]
+
+
+class TestSubscriberSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = api.SubscriberSnapshot()
+        self.snapshot.refresh(0, lambda: ROWS)
+
+    def assertConsistent(self):
+        c = self.snapshot.columns
+        self.assertEqual(len(c.ids), len(c.index))
+        for column in (c.ocene, c.ime, c.priimek, c.uporabnisko_ime, c.telefonska_stevilka):
+            self.assertEqual(len(column), len(c.ids))
+        for id, i in c.index.items():
+            self.assertEqual(c.ids[i], id)
+
+    def test_delete_swap_remove(self):
+        self.snapshot.delete(2)
+        self.snapshot.delete(5)
+        self.snapshot.delete(42)
+        self.assertConsistent()
+        rows = {r.id: r for r in self.snapshot.rows()}
+        self.assertEqual(sorted(rows), [1, 3, 4])
+        self.assertEqual(rows[4].ime, "Dora")
+        self.assertEqual(rows[4].ocena, "abc")
+        self.snapshot.upsert((6, "Fran", "Oblak", "3", "fo", "666"))
+        self.snapshot.delete(1)
+        self.assertConsistent()
+        self.assertEqual(sorted(r.id for r in self.snapshot.rows()), [3, 4, 6])
+
+    def test_ranking_follows_rating_changes(self):
+        self.assertEqual([r[1] for r in self.snapshot.ranking()], [2, 5, 1])
+        self.snapshot.set_ocena(1, "10")
+        self.snapshot.set_ocena(4, "99999999999999999999")
+        self.assertEqual([r[1] for r in self.snapshot.ranking()], [1, 2, 5])
+        self.snapshot.delete(2)
+        self.assertEqual([(r[0], r[1]) for r in self.snapshot.ranking()], [(1, 1), (2, 5)])
+
+    def test_writes_during_refresh_are_kept(self):
+        snapshot = api.SubscriberSnapshot()
+
+        def rows():
+            # Pisanja med gradnjo novih stolpcev
+            snapshot.set_ocena(1, "50")
+            snapshot.delete(3)
+            return ROWS
+
+        snapshot.refresh(0, rows)
+        ranking = snapshot.ranking()
+        self.assertEqual(ranking[0][1:], (1, "Ana", "Novak", "50"))
+        self.assertNotIn(3, [r.id for r in snapshot.rows()])
+
+
+class StubRatingBuffer(api.RatingBuffer):
+    """
+    Medpomnilnik brez baze: write si zapomni pakete in sprozi napake iz self.errors.
+    """
+
+    def __init__(self):
+        self.writes = []
+        self.errors = []
+        super(StubRatingBuffer, self).__init__(interval=3600, batch_size=1000)
+
+    def write(self, batch):
+        self.writes.append({id: list(entry) for id, entry in batch.items()})
+        error = self.errors.pop(0) if self.errors else None
+        if error is not None:
+            raise error
+        return [(id, str(vrednost)) for id, (nastavi, vrednost) in batch.items()]
+
+
+class TestRatingBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.ratings = StubRatingBuffer()
+
+    def tearDown(self):
+        self.ratings.errors = []
+        self.ratings.close()
+
+    def test_merge(self):
+        pending = {}
+        api.RatingBuffer.merge(pending, 101, True, 5)
+        api.RatingBuffer.merge(pending, 101, False, 2)
+        api.RatingBuffer.merge(pending, 102, False, 2)
+        api.RatingBuffer.merge(pending, 102, False, -7)
+        api.RatingBuffer.merge(pending, 103, False, 4)
+        api.RatingBuffer.merge(pending, 103, True, 1)
+        self.assertEqual(pending, {101: [True, 7], 102: [False, -5], 103: [True, 1]})
+
+    def test_merge_stays_in_bigint(self):
+        pending = {}
+        for _ in range(5):
+            api.RatingBuffer.merge(pending, 101, False, api.MAX_OCENA)
+        self.assertEqual(pending[101], [False, 2 * api.MAX_OCENA])
+        self.assertLess(pending[101][1], 2 ** 63)
+
+    def test_flush_writes_merged_batch(self):
+        self.ratings.add(101, False, 1)
+        self.ratings.add(101, False, 2)
+        self.ratings.add(102, True, 9)
+        self.assertEqual(self.ratings.flush(), 2)
+        self.assertEqual(self.ratings.writes, [{101: [False, 3], 102: [True, 9]}])
+        self.assertEqual(self.ratings.pending, {})
+
+    def test_transient_error_requeues_ahead_of_newer(self):
+        self.ratings.add(101, True, 5)
+        self.ratings.add(102, False, 1)
+        self.ratings.errors = [api.pg.OperationalError("povezava prekinjena")]
+        self.assertEqual(self.ratings.flush(), 0)
+        self.assertGreater(self.ratings.backoff, 0)
+        self.ratings.add(103, False, 4)
+        self.ratings.add(101, False, 2)
+        self.assertEqual(list(self.ratings.pending), [101, 102, 103])
+        self.assertEqual(
+            self.ratings.pending, {101: [True, 7], 102: [False, 1], 103: [False, 4]}
+        )
+        self.assertEqual(self.ratings.flush(), 3)
+        self.assertEqual(self.ratings.backoff, 0)
+
+    def test_data_error_drops_only_bad_row(self):
+        self.ratings.add(101, True, 1)
+        self.ratings.add(102, True, 2)
+        self.ratings.add(103, True, 3)
+        # Paket, nato vrstice 101, 102 (napaka v podatkih) in 103
+        self.ratings.errors = [api.pg.DataError("paket"), None, api.pg.DataError("102")]
+        self.assertEqual(self.ratings.flush(), 2)
+        self.assertEqual(
+            self.ratings.writes[1:], [{101: [True, 1]}, {102: [True, 2]}, {103: [True, 3]}]
+        )
+        self.assertEqual(self.ratings.pending, {})
+
+    def test_transient_error_while_isolating_requeues_rest(self):
+        self.ratings.add(101, True, 1)
+        self.ratings.add(102, True, 2)
+        self.ratings.add(103, True, 3)
+        self.ratings.errors = [
+            api.pg.DataError("paket"),
+            None,
+            api.pg.OperationalError("povezava prekinjena"),
+        ]
+        self.assertEqual(self.ratings.flush(), 1)
+        self.assertEqual(self.ratings.pending, {102: [True, 2], 103: [True, 3]})
+
+    def test_add_after_close_is_refused(self):
+        self.ratings.add(101, True, 1)
+        self.ratings.close()
+        self.assertEqual(self.ratings.writes, [{101: [True, 1]}])
+        self.assertFalse(self.ratings.add(102, True, 2))
+        self.assertEqual(self.ratings.pending, {})
+
+
+class TestIdempotencyStore(unittest.TestCase):
+
+    def test_negative_id_is_not_in_progress(self):
+        store = api.IdempotencyStore(ttl=60, max_keys=10)
+        self.assertIsNone(store.begin("kljuc", "podatki"))
+        self.assertEqual(store.begin("kljuc", "podatki"), (True, api.IdempotencyStore.IN_PROGRESS))
+        store.finish("kljuc", "podatki", -1)
+        same_payload, id = store.begin("kljuc", "podatki")
+        self.assertTrue(same_payload)
+        self.assertEqual(id, -1)
+        self.assertIsNot(id, api.IdempotencyStore.IN_PROGRESS)
+
+
+def init_local_app():
+    # init_app se v procesu izvede le enkrat, zato vsi lokalni testi uporabijo iste nastavitve
+    os.environ.update({
+        "SNAPSHOT_ENABLED": "true",
+        "SNAPSHOT_MAX_AGE": "0",
+        "FLUENT_IP": "127.0.0.1",
+    })
+    api.init_app()
+    return api.app.test_client()
+
+
+class TestAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.client = init_local_app()
+        self.admission = api.admission
+
+    def tearDown(self):
+        api.admission = self.admission
+
+    def control(self, rate, burst, pregled):
+        return api.AdmissionControl(
+            limits={"tocka": 1, "pregled": pregled, "izvoz": 1},
+            queue_size=0,
+            queue_timeout=0,
+            rate=rate,
+            burst=burst,
+            max_clients=10,
+        )
+
+    def test_head_is_rate_limited(self):
+        api.admission = self.control(rate=1, burst=0, pregled=1)
+        resp = self.client.head("/narocniki")
+        self.assertEqual(resp.status_code, 429)
+        self.assertGreaterEqual(int(resp.headers["Retry-After"]), 1)
+
+    def test_head_needs_a_slot(self):
+        api.admission = self.control(rate=0, burst=0, pregled=0)
+        resp = self.client.head("/narocniki")
+        self.assertEqual(resp.status_code, 503)
+
+
+class TestSnapshotEndpoints(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = init_local_app()
+        api.snapshot.refresh(0, lambda: ROWS)
+
+    def test_lestvica(self):
+        resp = self.client.get("/lestvica")
+        self.assertEqual(resp.status_code, 200)
+        narocniki = resp.get_json()["narocniki"]
+        self.assertEqual([n["id"] for n in narocniki], [2, 5, 1])
+        self.assertEqual(narocniki[0]["mesto"], "1.mesto")
+
+    def test_loto(self):
+        resp = self.client.get("/loto")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(resp.get_json()["id"], [row[0] for row in ROWS])
+
+    def test_list(self):
+        resp = self.client.get("/narocniki")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.get_json()["narocniki"]), len(ROWS))
+
+
 if __name__ == '__main__':
     unittest.main()
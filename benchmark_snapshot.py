@@ -0,0 +1,74 @@
+"""
+Meri porabo pomnilnika in hitrost posnetka narocnikov (SubscriberSnapshot).
+
+Posnetek se zgradi iz umetnih vrstic, zato baza ni potrebna:
+
+    pipenv run python benchmark_snapshot.py --rows 1000000
+"""
+import argparse
+import random
+import tracemalloc
+from time import perf_counter
+
+import api
+
+IMENA = ["Ana", "Bojan", "Cene", "Darja", "Eva", "Franc", "Gregor", "Hana", "Iva", "Jure"]
+PRIIMKI = ["Novak", "Horvat", "Kovacic", "Krajnc", "Zupancic", "Potocnik", "Mlakar"]
+
+
+def synthetic_rows(n):
+    for id in range(n):
+        yield (
+            id,
+            random.choice(IMENA).ljust(20),
+            random.choice(PRIIMKI).ljust(20),
+            str(random.randint(-1, 100)).ljust(20),
+            ("uporabnik%d" % id).ljust(20),
+            ("0%08d" % id).ljust(20),
+        )
+
+
+def timed(label, fn, repeat):
+    best = min(_once(fn) for _ in range(repeat))
+    print("%-22s %10.3f ms" % (label, best * 1000))
+
+
+def _once(fn):
+    start = perf_counter()
+    fn()
+    return perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = list(synthetic_rows(args.rows))
+
+    # Cas nalaganja se meri brez tracemalloc, ki gradnjo mocno upocasni
+    snapshot = api.SubscriberSnapshot()
+    start = perf_counter()
+    snapshot.refresh(0, lambda: rows)
+    loaded = perf_counter() - start
+
+    tracemalloc.start()
+    traced = api.SubscriberSnapshot()
+    traced.refresh(0, lambda: rows)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del traced
+
+    print("vrstice                %10d" % args.rows)
+    print("nalaganje              %10.3f ms" % (loaded * 1000))
+    print("pomnilnik              %10.1f MiB" % (used / 2 ** 20))
+    print("pomnilnik na 1M        %10.1f MiB" % (used / 2 ** 20 * 1000000 / args.rows))
+    timed("nakljucni narocnik", snapshot.random_row, args.repeat)
+    timed("posodobitev ocene", lambda: snapshot.set_ocena(args.rows // 2, "42"), args.repeat)
+    timed("lestvica", snapshot.ranking, args.repeat)
+    timed("vsi narocniki", snapshot.rows, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Meri cas uvoza modula api in zakasnitev prve zahteve.
+
+Vsaka ponovitev tece v novem procesu, zato meritve vkljucujejo hladen uvoz vseh odvisnosti:
+
+    pipenv run python benchmark_startup.py --repeat 10
+    pipenv run python benchmark_startup.py --path /narocniki/1
+
+Pot z dostopom do baze vkljucuje se ustvarjanje bazena povezav in pripravo stavkov.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+MEASURE = """
+import json
+from time import perf_counter
+
+start = perf_counter()
+import api
+imported = perf_counter()
+api.init_app()
+initialized = perf_counter()
+client = api.app.test_client()
+client.get(%(path)r)
+first = perf_counter()
+client.get(%(path)r)
+second = perf_counter()
+print(json.dumps({
+    "uvoz": imported - start,
+    "init_app": initialized - imported,
+    "prva_zahteva": first - initialized,
+    "druga_zahteva": second - first,
+}))
+"""
+
+
+def measure(path):
+    out = subprocess.run(
+        [sys.executable, "-c", MEASURE % {"path": path}],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--path", default="/")
+    args = parser.parse_args()
+
+    runs = [measure(args.path) for _ in range(args.repeat)]
+    for key in runs[0]:
+        values = [run[key] * 1000 for run in runs]
+        print(
+            "%-14s min %8.2f ms  mediana %8.2f ms  max %8.2f ms"
+            % (key, min(values), statistics.median(values), max(values))
+        )
+
+
+if __name__ == "__main__":
+    main()